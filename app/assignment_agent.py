@@ -1,11 +1,26 @@
-import os, re, json
-from typing import List, Dict
+import re, time, asyncio
+import orjson
+from collections import Counter
+from typing import List, Dict, NamedTuple
 from sqlalchemy import text
-from openai import OpenAI
-from app.retriever import top_k_similar, embed_text
+from pydantic import ValidationError
+from app.retriever import top_k_similar, top_k_similar_many, embed_text, embed_texts
 from app.db import engine
-
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""))
+from app.config import get_settings
+from app.llm_client import client, async_client
+from app.schemas import AssignmentOut
+from app.semantic_cache import SemanticCache, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL
+
+# Teams change rarely; reload them at most this often (seconds)
+TEAMS_CACHE_TTL = 300
+# Few-shot examples only need a hint of the resolution, not the full answer
+EXAMPLE_ANSWER_CHARS = 200
+# Skip the LLM when this share of (at least KNN_CONSENSUS_MIN) neighbor tickets agree on a team
+KNN_CONSENSUS_RATIO = 0.8
+KNN_CONSENSUS_MIN = 3
+
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+_BRACE_RE = re.compile(r"\{.*\}", re.DOTALL)
 
 # ------------------------------
 # Helper functions
@@ -13,18 +28,27 @@ client = OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""))
 def safe_parse_json(text_in: str) -> dict:
     if not isinstance(text_in, str):
         return {"assigned_team_id": "", "assigned_team_name": "", "reasoning": "Non-string model output."}
-    text_in = re.sub(r"^```(?:json)?\s*|\s*```$", "", text_in.strip(), flags=re.IGNORECASE)
+    text_in = _FENCE_RE.sub("", text_in.strip())
     try:
-        return json.loads(text_in)
+        return orjson.loads(text_in)
     except Exception:
-        m = re.search(r"\{.*\}", text_in, flags=re.DOTALL)
+        m = _BRACE_RE.search(text_in)
         if m:
             try:
-                return json.loads(m.group(0))
+                return orjson.loads(m.group(0))
             except Exception:
                 pass
     return {"assigned_team_id": "", "assigned_team_name": text_in.strip(), "reasoning": "Parsed from non-JSON output."}
 
+def parse_assignment(raw) -> dict:
+    """Strict schema validation on the happy path; regex salvage only if that fails."""
+    if isinstance(raw, str):
+        try:
+            return AssignmentOut.model_validate_json(raw).model_dump(exclude_none=True)
+        except ValidationError:
+            pass
+    return safe_parse_json(raw)
+
 def load_all_teams() -> List[Dict[str, str]]:
     with engine.begin() as conn:
         rows = conn.execute(text("SELECT team_id, team_name FROM teams ORDER BY team_name")).mappings().all()
@@ -34,88 +58,274 @@ def normalize(s: str) -> str:
     return (s or "").strip().lower()
 
 
+class TeamSnapshot(NamedTuple):
+    """Everything derived from the team list, rebuilt together on each cache refresh."""
+    teams: List[Dict[str, str]]
+    by_id: Dict[str, Dict[str, str]]      # normalized team_id -> team
+    by_name: Dict[str, Dict[str, str]]    # normalized team_name -> team
+    options_json: str
+    system_prompt: str
+
+
 # ------------------------------
 # Assignment Agent Class
 # ------------------------------
 class AssignmentAgent:
-    def __init__(self, engine):
+    def __init__(self, engine, async_llm=None):
         self.engine = engine
+        # Callers running their own event loop pass a client bound to it
+        self.async_llm = async_llm or async_client
+        # Swapped as one object on refresh so a request never mixes two team lists
+        self._teams_cache = TeamSnapshot([], {}, {}, "[]", "")
+        self._teams_cache_ts: float = 0.0
+        # Near-duplicate tickets reuse a recent assignment
+        self._sem_cache = SemanticCache(
+            get_settings().embedding_dim,
+            threshold=SEMANTIC_CACHE_THRESHOLD, max_size=SEMANTIC_CACHE_SIZE, ttl=SEMANTIC_CACHE_TTL,
+        )
         print("✅ AssignmentAgent ready (with retry mechanism)")
 
+    # ------------------------------
+    # ✅ Cached team list (avoids one DB round-trip per ticket)
+    # ------------------------------
+    def _get_teams(self) -> TeamSnapshot:
+        """Return the cached TeamSnapshot, reloading it once the TTL expires."""
+        if self._teams_cache.teams and time.monotonic() - self._teams_cache_ts < TEAMS_CACHE_TTL:
+            return self._teams_cache
+
+        teams = load_all_teams()
+        options_json = orjson.dumps(teams).decode()
+        self._teams_cache = TeamSnapshot(
+            teams=teams,
+            by_id={normalize(t["team_id"]): t for t in teams},
+            by_name={normalize(t["team_name"]): t for t in teams},
+            options_json=options_json,
+            system_prompt=self._build_system_prompt(options_json),
+        )
+        self._teams_cache_ts = time.monotonic()
+        return self._teams_cache
+
+    def invalidate_teams(self):
+        """Force the next call to reload teams from the database."""
+        self._teams_cache_ts = 0.0
+
     # ✅ Main public method
-    def assign_team(self, ticket_id:int, subject: str, body: str, top_k: int = 5):
-        # 1️⃣ Load valid teams from DB
-        candidates = load_all_teams()
-        if not candidates:
-            return {
-                "assigned_team_id": "",
-                "assigned_team_name": "Unassigned",
-                "reasoning": "No teams found in database."
-            }
+    def assign_team(self, ticket_id:int, subject: str, body: str, top_k: int = 5, qvec=None):
+        # 1️⃣ Load valid teams (cached)
+        teams = self._get_teams()
+        if not teams.teams:
+            return self._no_teams_result()
 
         # 2️⃣ Retrieve similar tickets
         query_text = f"Subject: {subject}\nBody: {body}"
-        qvec = embed_text(query_text)
+        if qvec is None:
+            qvec = embed_text(query_text)
+        cached = self._cached_assignment(qvec, teams)
+        if cached:
+            return cached
         sims = top_k_similar(qvec, top_k=top_k, exclude_ticket_id=ticket_id)
+        consensus = self._knn_consensus(sims, teams)
+        if consensus:
+            return consensus
 
-        # 3️⃣ Build context for prompt
-        examples = []
-        for t in sims:
-            team_label = t.get("assigned_team_name") or "Unknown"
-            examples.append(
-                f"Title: {t.get('title')}\n"
-                f"Answer: {t.get('answer') or 'N/A'}\n"
-                f"Team: {team_label}\n---"
+        # 3️⃣ Compose the ticket-specific part of the prompt
+        user_prompt = self._build_user_prompt(query_text, sims)
+
+        # 4️⃣ Call the LLM
+        resp = client.chat.completions.create(**self.build_request(teams.system_prompt, user_prompt))
+        raw = resp.choices[0].message.content
+        parsed = parse_assignment(raw)
+
+        # 5️⃣ Validate result
+        valid_result = self._validate_or_retry(parsed, query_text, teams)
+        self._remember_assignment(qvec, valid_result)
+        return valid_result
+
+    # ✅ Async variant: same flow, but the LLM call does not block a thread
+    async def assign_team_async(self, ticket_id: int, subject: str, body: str, top_k: int = 5, qvec=None, sims=None):
+        teams = await asyncio.to_thread(self._get_teams)
+        if not teams.teams:
+            return self._no_teams_result()
+
+        query_text = f"Subject: {subject}\nBody: {body}"
+        if qvec is None:
+            qvec = await asyncio.to_thread(embed_text, query_text)
+        cached = self._cached_assignment(qvec, teams)
+        if cached:
+            return cached
+        if sims is None:
+            sims = await asyncio.to_thread(top_k_similar, qvec, top_k, ticket_id)
+        consensus = self._knn_consensus(sims, teams)
+        if consensus:
+            return consensus
+
+        user_prompt = self._build_user_prompt(query_text, sims)
+        resp = await self.async_llm.chat.completions.create(**self.build_request(teams.system_prompt, user_prompt))
+        parsed = parse_assignment(resp.choices[0].message.content)
+
+        valid_result = await self._validate_or_retry_async(parsed, query_text, teams)
+        self._remember_assignment(qvec, valid_result)
+        return valid_result
+
+    # ✅ Bulk variant: one embedding pass and one k-NN query for the whole batch
+    async def batch_assign(
+        self, tickets: List[Dict], top_k: int = 5, qvecs=None, concurrency: int = 32, exclude_ids=None
+    ):
+        """
+        Assign many tickets (dicts with ticket_id/subject/body). LLM calls run concurrently,
+        at most `concurrency` at a time. Returns one result per ticket, or the exception it raised.
+        exclude_ids: optional per-ticket lists of other ticket ids to keep out of its neighbours.
+        """
+        if qvecs is None:
+            qvecs = await asyncio.to_thread(
+                embed_texts, [f"Subject: {t['subject']}\nBody: {t['body']}" for t in tickets]
             )
-        examples_text = "\n".join(examples) if examples else "No prior examples."
+        if exclude_ids is None:
+            exclude_ids = [()] * len(tickets)
+        sims_per_ticket = await asyncio.to_thread(
+            top_k_similar_many, qvecs, top_k, [[t["ticket_id"], *ex] for t, ex in zip(tickets, exclude_ids)]
+        )
 
-        # 4️⃣ Build team list JSON
-        options_json = json.dumps(candidates, ensure_ascii=False)
+        sem = asyncio.Semaphore(concurrency)
 
-        # 5️⃣ Compose the initial LLM prompt
-        prompt = f"""
-You are an assignment agent. Choose the correct support team **only** from the provided list.
+        async def _one(t, qvec, sims):
+            async with sem:
+                return await self.assign_team_async(
+                    t["ticket_id"], t["subject"], t["body"], top_k, qvec=qvec, sims=sims
+                )
 
-New ticket:
-{query_text}
+        return await asyncio.gather(
+            *(_one(t, q, s) for t, q, s in zip(tickets, qvecs, sims_per_ticket)),
+            return_exceptions=True,
+        )
 
-Similar resolved tickets (with their teams):
-{examples_text}
+    @staticmethod
+    def _knn_consensus(sims, teams: TeamSnapshot):
+        """Return the neighbors' team directly if (nearly) all similar tickets agree on it."""
+        # sims are chunks; count each neighbor ticket once
+        neighbor_teams = {}
+        for t in sims:
+            if t.get("assigned_team_id"):
+                neighbor_teams.setdefault(t["ticket_id"], t["assigned_team_id"])
+        if len(neighbor_teams) < KNN_CONSENSUS_MIN:
+            return None
+
+        team_id, votes = Counter(neighbor_teams.values()).most_common(1)[0]
+        team = teams.by_id.get(normalize(team_id))
+        if not team or votes / len(neighbor_teams) < KNN_CONSENSUS_RATIO:
+            return None
+        return {
+            "assigned_team_id": team["team_id"],
+            "assigned_team_name": team["team_name"],
+            "reasoning": f"k-NN consensus: {votes} of {len(neighbor_teams)} similar tickets were resolved by this team."
+        }
+
+    # ------------------------------
+    # ✅ Semantic cache helpers
+    # ------------------------------
+    def _cached_assignment(self, qvec, teams: TeamSnapshot):
+        """Cached result for a near-duplicate ticket, if its team still exists."""
+        hit = self._sem_cache.get(qvec)
+        if hit and normalize(hit["assigned_team_id"]) in teams.by_id:
+            return hit
+        return None
+
+    def _remember_assignment(self, qvec, result):
+        # Only cache real assignments, never the Unassigned fallback
+        if result.get("assigned_team_id"):
+            self._sem_cache.put(qvec, result)
+
+    # ✅ Offline (Batch API) helpers
+    def build_assignment_request(self, ticket_id: int, subject: str, body: str, top_k: int = 5, qvec=None):
+        """
+        Build the chat.completions request body assign_team would send for this ticket,
+        without calling the LLM. Returns None if there are no teams to choose from.
+        """
+        teams = self._get_teams()
+        if not teams.teams:
+            return None
+        query_text = f"Subject: {subject}\nBody: {body}"
+        if qvec is None:
+            qvec = embed_text(query_text)
+        sims = top_k_similar(qvec, top_k=top_k, exclude_ticket_id=ticket_id)
+        return self.build_request(teams.system_prompt, self._build_user_prompt(query_text, sims))
+
+    def resolve_without_retry(self, parsed: dict) -> dict:
+        """Validate a model answer against known teams; invalid answers become Unassigned."""
+        teams = self._get_teams()
+        result = self._match_team(parsed, teams, "Selected by ID.", "Selected by name.")
+        if result:
+            return result
+        return {
+            "assigned_team_id": "",
+            "assigned_team_name": "Unassigned",
+            "reasoning": "Model returned an invalid team (no retry in batch mode)."
+        }
+
+    # ------------------------------
+    # ✅ Prompt builders
+    # ------------------------------
+    @staticmethod
+    def build_request(system_prompt: str, user_prompt: str) -> dict:
+        """Keyword arguments for chat.completions.create (also the Batch API request body)."""
+        return {
+            "model": "gpt-4o-mini",
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            "temperature": 0,
+            "response_format": {"type": "json_object"},
+        }
+
+    @staticmethod
+    def _build_system_prompt(options_json: str) -> str:
+        """
+        Static instructions + team list. Identical across tickets (until the team cache
+        refreshes), so OpenAI prompt caching can reuse it as a shared prefix.
+        """
+        return f"""
+You are an assignment agent. Choose the correct support team **only** from the provided list.
 
 Valid teams (choose exactly one by ID and name):
 {options_json}
 
+You will receive similar resolved tickets (with their teams) followed by the new ticket.
+
 Return ONLY a strict JSON object with these EXACT keys:
 {{"assigned_team_id": "<id from list>", "assigned_team_name": "<matching name from list>", "reasoning": "<short reason>"}}
 No extra text, no code fences, no markdown.
 """.strip()
 
-        # 6️⃣ Call the LLM
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-            response_format={"type": "json_object"}
-        )
-        raw = resp.choices[0].message.content
-        parsed = safe_parse_json(raw)
+    @staticmethod
+    def _build_user_prompt(query_text, sims) -> str:
+        # Build context from similar tickets
+        examples = []
+        for t in sims:
+            team_label = t.get("assigned_team_name") or "Unknown"
+            examples.append(
+                f"Title: {t.get('title')}\n"
+                f"Answer: {(t.get('answer') or 'N/A')[:EXAMPLE_ANSWER_CHARS]}\n"
+                f"Team: {team_label}\n---"
+            )
+        examples_text = "\n".join(examples) if examples else "No prior examples."
 
-        # 7️⃣ Validate result
-        valid_result = self._validate_or_retry(parsed, candidates, query_text)
-        return valid_result
+        # Ticket-specific content only; kept after the shared system prefix
+        return f"""
+Similar resolved tickets (with their teams):
+{examples_text}
 
-    # ------------------------------
-    # ✅ NEW helper method for retry logic
-    # ------------------------------
-    def _retry_llm_assignment(self, candidates, query_text):
-        """Ask the LLM again with a stronger prompt if first choice was invalid."""
-        print("⚠️ Model selected an invalid team — retrying once with explicit team list...")
+New ticket:
+{query_text}
+""".strip()
 
-        retry_prompt = f"""
+    @staticmethod
+    def _build_retry_prompt(options_json: str, query_text: str) -> str:
+        return f"""
 The previous response contained an invalid team name.
 
 You must select one valid team **only** from this list:
-{json.dumps(candidates, ensure_ascii=False)}
+{options_json}
 
 New ticket:
 {query_text}
@@ -124,65 +334,85 @@ Return ONLY a strict JSON object:
 {{"assigned_team_id": "<id from list>", "assigned_team_name": "<matching name>", "reasoning": "<short reason>"}}
 """.strip()
 
+    # ------------------------------
+    # ✅ NEW helper method for retry logic
+    # ------------------------------
+    def _retry_llm_assignment(self, query_text, teams: TeamSnapshot):
+        """Ask the LLM again with a stronger prompt if first choice was invalid."""
+        print("⚠️ Model selected an invalid team — retrying once with explicit team list...")
+
         retry_resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": retry_prompt}],
-            temperature=0,
-            response_format={"type": "json_object"}
+            **self.build_request(teams.system_prompt, self._build_retry_prompt(teams.options_json, query_text))
         )
 
         retry_raw = retry_resp.choices[0].message.content
-        retry_parsed = safe_parse_json(retry_raw)
+        retry_parsed = parse_assignment(retry_raw)
         return retry_parsed
 
+    async def _retry_llm_assignment_async(self, query_text, teams: TeamSnapshot):
+        """Async counterpart of _retry_llm_assignment."""
+        print("⚠️ Model selected an invalid team — retrying once with explicit team list...")
+
+        retry_resp = await self.async_llm.chat.completions.create(
+            **self.build_request(teams.system_prompt, self._build_retry_prompt(teams.options_json, query_text))
+        )
+        return parse_assignment(retry_resp.choices[0].message.content)
+
     # ------------------------------
     # ✅ Validation and Retry Wrapper
     # ------------------------------
-    def _validate_or_retry(self, parsed, candidates, query_text):
+    def _validate_or_retry(self, parsed, query_text, teams: TeamSnapshot):
         """Validate the LLM response; if invalid, retry once."""
+        result = self._match_team(parsed, teams, "Selected by ID.", "Selected by name.")
+        if result:
+            return result
+
+        # 🚀 Retry once if invalid
+        retry_parsed = self._retry_llm_assignment(query_text, teams)
+        return self._match_after_retry(retry_parsed, teams)
+
+    async def _validate_or_retry_async(self, parsed, query_text, teams: TeamSnapshot):
+        """Async counterpart of _validate_or_retry."""
+        result = self._match_team(parsed, teams, "Selected by ID.", "Selected by name.")
+        if result:
+            return result
+
+        retry_parsed = await self._retry_llm_assignment_async(query_text, teams)
+        return self._match_after_retry(retry_parsed, teams)
+
+    @staticmethod
+    def _match_team(parsed, teams: TeamSnapshot, id_reason, name_reason):
+        """Resolve the model's choice against known teams (by ID first, then by name)."""
         want_id = normalize(parsed.get("assigned_team_id", ""))
         want_name = normalize(parsed.get("assigned_team_name", ""))
 
         # Check if team exists in DB
-        by_id = next((t for t in candidates if normalize(t["team_id"]) == want_id), None)
-        by_name = next((t for t in candidates if normalize(t["team_name"]) == want_name), None)
-
+        by_id = teams.by_id.get(want_id)
         if by_id:
             return {
                 "assigned_team_id": by_id["team_id"],
                 "assigned_team_name": by_id["team_name"],
-                "reasoning": parsed.get("reasoning", "Selected by ID.")
+                "reasoning": parsed.get("reasoning", id_reason)
             }
 
+        by_name = teams.by_name.get(want_name)
         if by_name:
             return {
                 "assigned_team_id": by_name["team_id"],
                 "assigned_team_name": by_name["team_name"],
-                "reasoning": parsed.get("reasoning", "Selected by name.")
-            }
-
-        # 🚀 Retry once if invalid
-        retry_parsed = self._retry_llm_assignment(candidates, query_text)
-
-        want_id2 = normalize(retry_parsed.get("assigned_team_id", ""))
-        want_name2 = normalize(retry_parsed.get("assigned_team_name", ""))
-
-        by_id2 = next((t for t in candidates if normalize(t["team_id"]) == want_id2), None)
-        by_name2 = next((t for t in candidates if normalize(t["team_name"]) == want_name2), None)
-
-        if by_id2:
-            return {
-                "assigned_team_id": by_id2["team_id"],
-                "assigned_team_name": by_id2["team_name"],
-                "reasoning": retry_parsed.get("reasoning", "Valid team found after retry (by ID).")
-            }
-
-        if by_name2:
-            return {
-                "assigned_team_id": by_name2["team_id"],
-                "assigned_team_name": by_name2["team_name"],
-                "reasoning": retry_parsed.get("reasoning", "Valid team found after retry (by name).")
+                "reasoning": parsed.get("reasoning", name_reason)
             }
+        return None
+
+    def _match_after_retry(self, retry_parsed, teams: TeamSnapshot):
+        result = self._match_team(
+            retry_parsed,
+            teams,
+            "Valid team found after retry (by ID).",
+            "Valid team found after retry (by name).",
+        )
+        if result:
+            return result
 
         # 🚨 Still invalid → fallback
         print(f"❌ Retry failed. Model output: {retry_parsed}")
@@ -191,3 +421,11 @@ Return ONLY a strict JSON object:
             "assigned_team_name": "Unassigned",
             "reasoning": "Model failed twice to return a valid team from database."
         }
+
+    @staticmethod
+    def _no_teams_result():
+        return {
+            "assigned_team_id": "",
+            "assigned_team_name": "Unassigned",
+            "reasoning": "No teams found in database."
+        }
@@ -1,11 +1,28 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-load_dotenv()
 
 class Settings(BaseModel):
     database_url: str = Field(default_factory=lambda: os.getenv("DATABASE_URL", ""))
     embedding_model: str = Field(default_factory=lambda: os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2"))
+    openai_api_key: str = Field(default_factory=lambda: os.getenv("OPENAI_API_KEY", ""))
     embedding_dim: int = Field(default_factory=lambda: int(os.getenv("EMBEDDING_DIM", "384")))
+    db_pool_size: int = Field(default_factory=lambda: int(os.getenv("DB_POOL_SIZE", "20")))
+    db_max_overflow: int = Field(default_factory=lambda: int(os.getenv("DB_MAX_OVERFLOW", "20")))
+    db_pool_recycle: int = Field(default_factory=lambda: int(os.getenv("DB_POOL_RECYCLE", "1800")))
+    # HNSW candidate list size for k-NN queries (higher = better recall, slower). 100 covers
+    # the API's top_k <= 50 plus the retriever's margin; a larger top_k raises it for that query
+    hnsw_ef_search: int = Field(default_factory=lambda: int(os.getenv("HNSW_EF_SEARCH", "100")))
+    # Directory of an INT8 ONNX export of the embedding model; empty = PyTorch via sentence-transformers
+    embedding_onnx_path: str = Field(default_factory=lambda: os.getenv("EMBEDDING_ONNX_PATH", ""))
+    # Let the API run init_db() (extension + tables) at startup; opt-in for dev, migrations own the schema otherwise
+    auto_create_tables: bool = Field(default_factory=lambda: os.getenv("AUTO_CREATE_TABLES", "0") == "1")
+    # Run CREATE EXTENSION whenever app.db is imported (off by default)
+    init_pgvector_on_import: bool = Field(default_factory=lambda: os.getenv("INIT_PGVECTOR", "0") == "1")
 
-settings = Settings()
+@lru_cache
+def get_settings() -> Settings:
+    """Load .env and parse settings once per process (cache_clear() to override in tests)."""
+    load_dotenv()
+    return Settings()
@@ -1,14 +1,41 @@
-from datetime import datetime
-from sqlalchemy import select, text, func
-from sqlalchemy.orm import Session
-from langchain_huggingface import HuggingFaceEmbeddings
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from cachetools import TTLCache
+from sqlalchemy import select, func, exists, insert, update
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from .config import get_settings
 from .db import engine, SessionLocal
-from .models import Base, Ticket, Team, TeamMember, User, TicketEmbedding
+from .models import Ticket, Team, TeamMember, User, TicketEmbedding, utcnow
+from .embedding import get_embedder
+from .retriever import embed_text
 
-# Ensure tables exist (optional; comment if you run migrations)
-Base.metadata.create_all(engine)
+
+# Chunk embedding fans out over sub-batches on a small pool (see _embed_pool)
+EMBED_SUB_BATCH = 16
+_WS_RE = re.compile(r"\s+")
+
+@lru_cache(maxsize=1)
+def _embed_pool() -> ThreadPoolExecutor | None:
+    """
+    Pool sized to the cores left over by the model's own intra-op threads, so the
+    two don't oversubscribe; torch's process-wide thread count is never changed.
+    None when one forward pass already uses every core (the usual case).
+    """
+    if get_settings().embedding_onnx_path:
+        # onnxruntime spreads each batch across the cores itself
+        return None
+    try:
+        import torch
+    except ImportError:
+        return None
+    workers = (os.cpu_count() or 1) // max(1, torch.get_num_threads())
+    if workers <= 1:
+        return None
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed")
 
 class IndexerAgent:
     def __init__(self, engine, embedder):
@@ -17,30 +44,69 @@ class IndexerAgent:
         self.splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
 
     def index_ticket(self, ticket_id: int, text_value: str):
-        chunks = self.splitter.split_text(text_value or "")
-        if not chunks:
-            return 0
+        # All chunks go through one embed_documents call and one executemany insert
+        return self.index_many([(ticket_id, text_value)])
 
+    def index_many(self, tickets: list[tuple[int, str]], batch_size: int = 256) -> int:
+        """
+        Index several tickets at once: chunks from all tickets are embedded in batches
+        of about `batch_size` and written with executemany inserts, one commit per batch.
+        A ticket's chunks never span two batches, so a failure leaves no ticket half-indexed.
+        Returns the total number of chunks embedded.
+        """
+        total = 0
+        batch: list[dict] = []
+        for ticket_id, text_value in tickets:
+            # Collapsed whitespace = fewer tokens per chunk; whitespace-only chunks are dropped
+            batch.extend(
+                {"ticket_id": ticket_id, "chunk_text": chunk}
+                for raw in self.splitter.split_text(text_value or "")
+                if (chunk := _WS_RE.sub(" ", raw).strip())
+            )
+            if len(batch) >= batch_size:
+                total += self._write_batch(batch)
+                batch = []
+        if batch:
+            total += self._write_batch(batch)
+        return total
+
+    def _write_batch(self, rows: list[dict]) -> int:
+        # Embed before taking a connection, so none sits idle in a transaction during the CPU work
+        embs = self._embed_parallel([r["chunk_text"] for r in rows])
+        for r, emb in zip(rows, embs):
+            r["embedding"] = emb
+        # executemany: SQLAlchemy's insertmanyvalues sends this as multi-row
+        # INSERT ... VALUES pages (one round trip per page), like execute_values
         with self.engine.begin() as conn:
-            for chunk in chunks:
-                emb = self.embedder.embed_query(chunk)  # 384-d
-                # pgvector psycopg2 can take Python list directly with Vector type
-                conn.execute(
-                    text("""
-                        INSERT INTO ticket_embeddings (ticket_id, chunk_text, embedding)
-                        VALUES (:ticket_id, :chunk_text, :embedding)
-                    """),
-                    {"ticket_id": ticket_id, "chunk_text": chunk, "embedding": emb}
-                )
-        return len(chunks)
+            conn.execute(insert(TicketEmbedding), rows)
+        return len(rows)
+
+    def _embed_parallel(self, texts: list[str]) -> list[list[float]]:
+        pool = _embed_pool()
+        if pool is None or len(texts) <= EMBED_SUB_BATCH:
+            # One batch; intra-op threading parallelizes the forward pass
+            return self.embedder.embed_documents(texts)
+        # The forward pass releases the GIL, so sub-batches run side by side; order is kept
+        subs = [texts[i:i + EMBED_SUB_BATCH] for i in range(0, len(texts), EMBED_SUB_BATCH)]
+        return [emb for part in pool.map(self.embedder.embed_documents, subs) for emb in part]
 
 class TicketDataAgent:
-    def __init__(self, db_url: str | None = None):
-        self.session: Session = SessionLocal()
-        self.embedder = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    def __init__(self, db_url: str | None = None, embedder=None):
+        # Sessions are opened per call: handlers run in a thread pool, and a Session is not thread-safe
+        self.embedder = embedder or get_embedder()
         self.indexer = IndexerAgent(engine, self.embedder)
+        # subject/body rarely change; /similar, /assign and /solution all hit the same ticket
+        self._text_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+        # Query embedding of "Subject/Body", shared by the three endpoints for the same ticket
+        self._qvec_cache: TTLCache = TTLCache(maxsize=2048, ttl=300)
+        self._indexed: set[int] = set()
+        self._cache_lock = threading.Lock()
 
-    def create_ticket(self, **kwargs):
+    def create_ticket(self, **kwargs) -> tuple[Ticket, int]:
+        """
+        Insert a ticket and index its body.
+        Returns (ticket, indexed_chunks) so callers don't need a follow-up COUNT query.
+        """
         ticket = Ticket(
             ticket_id=kwargs.get("ticket_id"),
             requester_id=kwargs.get("requester_id"),
@@ -54,22 +120,27 @@ class TicketDataAgent:
             assigned_team_user_id=kwargs.get("assigned_team_user_id"),
             suggested_assigned_team_id=kwargs.get("suggested_assigned_team_id"),
             status=kwargs.get("status", "open"),
-            created_at=datetime.utcnow(),
+            created_at=utcnow(),
+            tags=(kwargs.get("tags") or [])[:8],
         )
-        # tags (up to 8)
-        tags = kwargs.get("tags") or []
-        for i, tag in enumerate(tags[:8], start=1):
-            setattr(ticket, f"tag_{i}", tag)
 
-        self.session.add(ticket)
-        self.session.commit()
+        with SessionLocal() as session:
+            session.add(ticket)
+            session.commit()
+            session.refresh(ticket)  # load generated columns before the session closes
+        with self._cache_lock:
+            self._text_cache.pop(ticket.ticket_id, None)
+            self._qvec_cache.pop(ticket.ticket_id, None)
+            self._indexed.discard(ticket.ticket_id)
 
+        indexed_chunks = 0
         if ticket.body:
-            self.indexer.index_ticket(ticket.ticket_id, ticket.body)
-        return ticket
+            indexed_chunks = self.indexer.index_ticket(ticket.ticket_id, ticket.body)
+        return ticket, indexed_chunks
 
     def read_ticket(self, ticket_id: int):
-        t = self.session.query(Ticket).filter_by(ticket_id=ticket_id).first()
+        with SessionLocal() as session:
+            t = session.query(Ticket).filter_by(ticket_id=ticket_id).first()
         if not t:
             return None
         return {
@@ -86,7 +157,7 @@ class TicketDataAgent:
             "suggested_assigned_team_id": t.suggested_assigned_team_id,
             "status": t.status,
             "created_at": t.created_at,
-            "tags": [getattr(t, f"tag_{i}") for i in range(1, 9)]
+            "tags": t.tags or []
         }
     
     
@@ -95,43 +166,65 @@ class TicketDataAgent:
         Set tickets.suggested_assigned_team_id = team_id for the given ticket_id.
         Returns True if updated, False if ticket not found or team invalid.
         """
-        # Validate team exists
-        team = self.session.execute(
-            select(Team).where(Team.team_id == team_id)
-        ).scalar_one_or_none()
-        if not team:
-            return False
-
-        # Find ticket
-        ticket = self.session.execute(
-            select(Ticket).where(Ticket.ticket_id == ticket_id)
-        ).scalar_one_or_none()
-        if not ticket:
-            return False
-
-        ticket.suggested_assigned_team_id = team_id
-        self.session.commit()
-        return True
+        # One statement: the team check is an EXISTS, RETURNING tells us if a row matched
+        with SessionLocal() as session:
+            updated = session.execute(
+                update(Ticket)
+                .where(Ticket.ticket_id == ticket_id, exists().where(Team.team_id == team_id))
+                .values(suggested_assigned_team_id=team_id)
+                .returning(Ticket.ticket_id)
+            ).scalar_one_or_none()
+            session.commit()
+        return updated is not None
     
     def get_ticket_text(self, ticket_id: int) -> dict | None:
         """
         Returns {"subject": str|None, "body": str|None} for a given ticket_id,
-        or None if not found.
+        or None if not found. Found tickets are cached for a few minutes.
         """
-        t = self.session.execute(
-            select(Ticket.subject, Ticket.body).where(Ticket.ticket_id == ticket_id)
-        ).first()
+        with self._cache_lock:
+            cached = self._text_cache.get(ticket_id)
+        if cached is not None:
+            return dict(cached)
+        with SessionLocal() as session:
+            t = session.execute(
+                select(Ticket.subject, Ticket.body).where(Ticket.ticket_id == ticket_id)
+            ).first()
         if not t:
             return None
-        return {"subject": t.subject, "body": t.body}
+        result = {"subject": t.subject, "body": t.body}
+        with self._cache_lock:
+            self._text_cache[ticket_id] = result
+        return dict(result)
+
+    def get_query_vec(self, ticket_id: int):
+        """
+        Embedding of the ticket's "Subject: ...\nBody: ..." text (what the agents search with),
+        cached per ticket_id. None if the ticket doesn't exist or has no text.
+        """
+        with self._cache_lock:
+            qvec = self._qvec_cache.get(ticket_id)
+        if qvec is not None:
+            return qvec
+        t = self.get_ticket_text(ticket_id)
+        if not t:
+            return None
+        query_text = f"Subject: {t['subject'] or ''}\nBody: {t['body'] or ''}".strip()
+        if not query_text:
+            return None
+        qvec = embed_text(query_text)
+        with self._cache_lock:
+            self._qvec_cache[ticket_id] = qvec
+        return qvec
 
     def count_ticket_embeddings(self, ticket_id: int) -> int:
         """
         How many chunks/embeddings exist for this ticket?
         """
-        res = self.session.execute(
-            select(func.count(TicketEmbedding.id)).where(TicketEmbedding.ticket_id == ticket_id)
-        ).scalar_one()
+        with SessionLocal() as session:
+            res = session.execute(
+                select(func.count(TicketEmbedding.id)).where(TicketEmbedding.ticket_id == ticket_id)
+            ).scalar_one()
         return int(res or 0)
 
     def ensure_indexed(self, ticket_id: int) -> int:
@@ -139,30 +232,57 @@ class TicketDataAgent:
         If the ticket has a body and no embeddings yet, index it now.
         Returns number of chunks embedded (0 if already indexed or no body).
         """
-        t = self.session.execute(
-            select(Ticket.ticket_id, Ticket.body).where(Ticket.ticket_id == ticket_id)
-        ).first()
+        if ticket_id in self._indexed:
+            return 0
+        # Body and "already has embeddings" in one round trip
+        has_emb = exists().where(TicketEmbedding.ticket_id == Ticket.ticket_id).label("has_emb")
+        with SessionLocal() as session:
+            t = session.execute(
+                select(Ticket.body, has_emb).where(Ticket.ticket_id == ticket_id)
+            ).first()
         if not t:
             return 0
-        if not t.body:
+        if t.has_emb:
+            self._indexed.add(ticket_id)
             return 0
-        existing = self.count_ticket_embeddings(ticket_id)
-        if existing > 0:
+        if not t.body:
             return 0
-        return self.indexer.index_ticket(ticket_id, t.body)
+        n = self.indexer.index_ticket(ticket_id, t.body)
+        self._indexed.add(ticket_id)
+        return n
     
+    def ensure_indexed_many(self, ticket_ids: list[int]) -> int:
+        """
+        Bulk version of ensure_indexed: one query finds which of these tickets have a
+        body but no embeddings yet, and only those get indexed.
+        Returns the total number of chunks embedded.
+        """
+        if not ticket_ids:
+            return 0
+        with SessionLocal() as session:
+            missing = session.execute(
+                select(Ticket.ticket_id, Ticket.body).where(
+                    Ticket.ticket_id.in_(ticket_ids),
+                    Ticket.body.is_not(None),
+                    ~exists().where(TicketEmbedding.ticket_id == Ticket.ticket_id),
+                )
+            ).all()
+        n = self.indexer.index_many([(t.ticket_id, t.body) for t in missing])
+        self._indexed.update(t.ticket_id for t in missing)
+        return n
+
     def update_suggested_answer(self, ticket_id: int, solution_text: str) -> bool:
         """
         Store the generated solution into tickets.suggested_answer.
         Returns True if updated, False if ticket not found.
         """
-        ticket = self.session.execute(
-            select(Ticket).where(Ticket.ticket_id == ticket_id)
-        ).scalar_one_or_none()
-        if not ticket:
-            return False
-
-        ticket.suggested_answer = solution_text
-        self.session.commit()
-        return True
+        with SessionLocal() as session:
+            updated = session.execute(
+                update(Ticket)
+                .where(Ticket.ticket_id == ticket_id)
+                .values(suggested_answer=solution_text)
+                .returning(Ticket.ticket_id)
+            ).scalar_one_or_none()
+            session.commit()
+        return updated is not None
     
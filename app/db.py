@@ -1,12 +1,77 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
-from .config import settings
+from .config import get_settings
 
-engine = create_engine(settings.database_url, pool_pre_ping=True, future=True)
+settings = get_settings()
+
+engine = create_engine(
+    settings.database_url,
+    pool_pre_ping=True,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_recycle=settings.db_pool_recycle,
+    future=True,
+)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+# Same pool, no BEGIN/COMMIT around single read-only statements
+autocommit_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+
+@event.listens_for(engine, "connect")
+def _register_vector(dbapi_conn, _record):
+    # Lets numpy arrays be bound directly as vector parameters
+    if engine.dialect.driver == "psycopg2":
+        from pgvector.psycopg2 import register_vector
+    else:
+        from pgvector.psycopg import register_vector
+    try:
+        register_vector(dbapi_conn)
+    except Exception as e:
+        # vector extension not created yet; init_pgvector() resets the pool afterwards
+        dbapi_conn.rollback()
+        print(f"⚠️ pgvector type not registered on this connection: {e}")
+        return
+    # Session-level default for the autocommit reads in top_k_similar (raised per query for large top_k)
+    cur = dbapi_conn.cursor()
+    cur.execute(f"SET hnsw.ef_search = {int(settings.hnsw_ef_search)}")
+    cur.close()
+    dbapi_conn.commit()
 
-# Ensure pgvector and column exist (safe to run each start)
+# Ensure pgvector exists (run before creating vector tables). Never called on import unless
+# INIT_PGVECTOR=1; the explicit entry points are init_db() and python -m app.db.
 def init_pgvector():
+    with engine.connect() as conn:
+        installed = conn.execute(
+            text("SELECT 1 FROM pg_extension WHERE extname = 'vector'")
+        ).scalar() is not None
+    if installed:
+        # Common case: a read instead of a DDL transaction, and the pool stays warm
+        return
     with engine.begin() as conn:
         conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
-init_pgvector()
+    # Reconnect so every pooled connection registers the vector type
+    engine.dispose()
+
+# create_all only adds indexes to new tables; this backfills the ANN index on existing ones.
+# CONCURRENTLY (so writes aren't blocked) can't run in a transaction, hence autocommit.
+# Manual/one-off only (python -m app.db); never called on app startup.
+def ensure_vector_index():
+    with autocommit_engine.connect() as conn:
+        conn.execute(text("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ticket_embeddings_embedding_halfvec_ip
+            ON ticket_embeddings USING hnsw (embedding halfvec_ip_ops)
+            WITH (m = 16, ef_construction = 64);
+        """))
+
+def init_db():
+    """Create the pgvector extension and all tables (idempotent; new tables get their ANN index)."""
+    from .models import Base
+    init_pgvector()
+    Base.metadata.create_all(engine)
+
+if settings.init_pgvector_on_import:
+    init_pgvector()
+
+if __name__ == "__main__":
+    init_db()
+    ensure_vector_index()
+    print("✅ Database initialized")
@@ -0,0 +1,17 @@
+from functools import lru_cache
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from .config import get_settings
+from .onnx_embedder import OnnxMiniLMEmbedder
+
+
+@lru_cache
+def get_embedder():
+    """The process-wide embedding model (384-d), loaded on first use and shared by every caller."""
+    settings = get_settings()
+    if settings.embedding_onnx_path:
+        return OnnxMiniLMEmbedder(settings.embedding_onnx_path)
+    return HuggingFaceEmbeddings(
+        model_name=settings.embedding_model,
+        encode_kwargs={"batch_size": 32, "normalize_embeddings": True},
+    )
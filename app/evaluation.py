@@ -0,0 +1,424 @@
+"""
+Online evaluation sweeps, run with bounded concurrency:
+- assignment: assign_team_async vs. the ticket's assigned_team_id
+- solution: generate_solution_async graded against the ticket's answer, by embedding
+  cosine similarity (default) or an LLM judge
+Near-duplicate tickets (by embedding) share one LLM call per cluster; the cluster is kept
+out of its representative's retrieval so no ticket is graded on its own label.
+
+Usage:
+    python -m app.evaluation [limit] [concurrency] [checkpoint_path]
+"""
+import asyncio, os, sys
+import orjson
+import numpy as np
+from sqlalchemy import select, func
+
+from app.db import SessionLocal, engine
+from app.models import Ticket
+from app.assignment_agent import AssignmentAgent, normalize
+from app.solution_agent import SolutionAgent
+from app.data_agent import TicketDataAgent
+from app.llm_client import new_async_client
+from app.retriever import embed_texts
+
+
+# Tickets whose "subject body" text is shorter than this are skipped by both sweeps
+MIN_TEXT_LEN = 20
+
+
+def _has_enough_text():
+    """SQL filter for the skip policy, so short/empty tickets are never transferred."""
+    text_len = func.char_length(
+        func.btrim(func.coalesce(Ticket.subject, "") + " " + func.coalesce(Ticket.body, ""))
+    )
+    return text_len >= MIN_TEXT_LEN
+
+
+# Representatives sent through AssignmentAgent.batch_assign at a time
+EVAL_BATCH_SIZE = 64
+
+# Tickets at least this similar (cosine of their embeddings) share one LLM call
+DEDUP_THRESHOLD = 0.95
+
+
+def near_duplicate_representatives(vecs, threshold: float = DEDUP_THRESHOLD) -> list[int]:
+    """
+    Greedy leader clustering: index i maps to the first earlier representative with
+    cosine >= threshold, or to itself if there is none.
+    """
+    mat = np.asarray(vecs, dtype=np.float32)
+    if mat.size == 0:
+        return []
+    mat /= np.maximum(np.linalg.norm(mat, axis=1, keepdims=True), 1e-12)
+    rep_vecs = np.empty_like(mat)
+    rep_idx: list[int] = []
+    rep_of: list[int] = []
+    for i, v in enumerate(mat):
+        if rep_idx:
+            scores = rep_vecs[:len(rep_idx)] @ v
+            j = int(np.argmax(scores))
+            if scores[j] >= threshold:
+                rep_of.append(rep_idx[j])
+                continue
+        rep_vecs[len(rep_idx)] = v
+        rep_idx.append(i)
+        rep_of.append(i)
+    return rep_of
+
+
+def load_eval_tickets(limit: int = 3000):
+    """Tickets with a known team and enough text to classify."""
+    # Only the needed columns, streamed in chunks (no ORM entity hydration)
+    stmt = (
+        select(Ticket.ticket_id, Ticket.subject, Ticket.body, Ticket.assigned_team_id)
+        .where(Ticket.assigned_team_id.is_not(None), _has_enough_text())
+        .limit(limit)
+        .execution_options(yield_per=200)
+    )
+
+    tickets = []
+    with SessionLocal() as session:
+        for t in session.execute(stmt):
+            tickets.append({
+                "ticket_id": t.ticket_id,
+                "subject": t.subject or "",
+                "body": t.body or "",
+                "assigned_team_id": t.assigned_team_id,
+            })
+    return tickets
+
+
+def _load_checkpoint(path: str | None) -> dict[str, str]:
+    """Predictions (ticket_id -> team id) saved by an earlier, interrupted run."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        return orjson.loads(f.read()).get("predictions", {})
+
+
+def _save_checkpoint(path: str | None, counts: dict, predictions: dict[str, str]):
+    if not path:
+        return
+    # Write-then-rename so an abort mid-write never leaves a truncated checkpoint
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps({"counts": counts, "predictions": predictions}))
+    os.replace(tmp, path)
+
+
+async def run_assignment_evaluation_async(
+    limit: int = 3000, top_k: int = 5, concurrency: int = 32, checkpoint_path: str | None = None
+) -> dict:
+    """
+    With checkpoint_path, the running tallies and successful predictions are saved after every
+    batch; a rerun after an abort (e.g. rate limits) resumes from there. Removed on completion.
+    """
+    # Own client per run: its HTTP/2 pool is bound to this event loop, which asyncio.run() closes
+    llm = new_async_client()
+    try:
+        return await _assignment_sweep(llm, limit, top_k, concurrency, checkpoint_path)
+    finally:
+        await llm.close()
+
+
+async def _assignment_sweep(llm, limit: int, top_k: int, concurrency: int, checkpoint_path: str | None) -> dict:
+    agent = AssignmentAgent(engine, async_llm=llm)
+    tickets = load_eval_tickets(limit)
+    if not tickets:
+        return {"total": 0, "correct": 0, "incorrect": 0, "failed": 0, "accuracy": 0.0}
+
+    # One bulk check/index pass instead of ensure_indexed per ticket
+    await asyncio.to_thread(TicketDataAgent().ensure_indexed_many, [t["ticket_id"] for t in tickets])
+
+    qvecs = await asyncio.to_thread(
+        embed_texts, [f"Subject: {t['subject']}\nBody: {t['body']}" for t in tickets]
+    )
+
+    # Near-duplicate tickets reuse their representative's prediction
+    rep_of = near_duplicate_representatives(qvecs)
+    members: dict[int, list[int]] = {}
+    for i, r in enumerate(rep_of):
+        members.setdefault(r, []).append(i)
+    reps = sorted(members)
+    # The whole cluster is kept out of the representative's neighbours: a follower's own team
+    # would otherwise vote in the k-NN consensus and the few-shot examples it is then graded on
+    cluster_ids = {r: [tickets[i]["ticket_id"] for i in m] for r, m in members.items()}
+    print(f"🔁 {len(tickets) - len(reps)} near-duplicate tickets reuse a representative's prediction")
+
+    counts = {"correct": 0, "incorrect": 0, "failed": 0}
+
+    def _score(rep: int, predicted: str | None):
+        # Tally the representative and every near-duplicate that shares its prediction
+        for i in members[rep]:
+            if predicted is None:
+                counts["failed"] += 1
+            elif normalize(predicted) == normalize(tickets[i]["assigned_team_id"]):
+                counts["correct"] += 1
+            else:
+                counts["incorrect"] += 1
+
+    saved = _load_checkpoint(checkpoint_path)
+    predictions: dict[str, str] = {}  # ticket_id -> team id; failed calls are left out so a resume retries them
+    todo = []
+    for r in reps:
+        tid = str(tickets[r]["ticket_id"])
+        if tid in saved:
+            predictions[tid] = saved[tid]
+            _score(r, saved[tid])
+        else:
+            todo.append(r)
+    if predictions:
+        print(f"↩️ Resumed {len(predictions)} representatives from {checkpoint_path}: {counts}")
+
+    # Batches of representatives: one k-NN query per batch, LLM calls capped by
+    # `concurrency` to stay under the OpenAI rate limit; tallies checkpointed per batch
+    for start in range(0, len(todo), EVAL_BATCH_SIZE):
+        batch = todo[start:start + EVAL_BATCH_SIZE]
+        results = await agent.batch_assign(
+            [tickets[i] for i in batch], top_k, qvecs=[qvecs[i] for i in batch], concurrency=concurrency,
+            exclude_ids=[cluster_ids[i] for i in batch],
+        )
+        for i, result in zip(batch, results):
+            if isinstance(result, Exception):
+                print(f"❌ Ticket {tickets[i]['ticket_id']} failed: {result}")
+                _score(i, None)
+            else:
+                predicted = result.get("assigned_team_id") or ""
+                predictions[str(tickets[i]["ticket_id"])] = predicted
+                _score(i, predicted)
+        _save_checkpoint(checkpoint_path, counts, predictions)
+        print(f"⏳ {start + len(batch)}/{len(todo)} representatives evaluated: {counts}")
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    total = len(tickets)
+    summary = {"total": total, **counts, "accuracy": counts["correct"] / total}
+    print(f"✅ Evaluation done: {summary}")
+    return summary
+
+
+def run_assignment_evaluation(
+    limit: int = 3000, top_k: int = 5, concurrency: int = 32, checkpoint_path: str | None = None
+) -> dict:
+    return asyncio.run(run_assignment_evaluation_async(limit, top_k, concurrency, checkpoint_path))
+
+
+# ------------------------------
+# Solution evaluation
+# ------------------------------
+GOOD_MATCH_THRESHOLD = 0.6
+PARTIAL_MATCH_THRESHOLD = 0.3
+JUDGE_EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 256
+
+def load_solution_eval_tickets(limit: int = 500):
+    """Tickets with a reference answer and enough text to solve."""
+    stmt = (
+        select(Ticket.ticket_id, Ticket.subject, Ticket.body, Ticket.answer)
+        # embeddings.create rejects empty strings, so blank reference answers are skipped too
+        .where(Ticket.answer.is_not(None), func.btrim(Ticket.answer) != "", _has_enough_text())
+        .limit(limit)
+        .execution_options(yield_per=200)
+    )
+    with SessionLocal() as session:
+        return [
+            {"ticket_id": t.ticket_id, "subject": t.subject or "", "body": t.body or "", "answer": t.answer}
+            for t in session.execute(stmt)
+        ]
+
+
+_JUDGE_SYSTEM_PROMPT = """
+You are grading a helpdesk solution against the reference answer that actually resolved the ticket.
+Judge whether both describe the same fix, ignoring wording and formatting.
+similarity is 0..1; good_match if >= 0.6, partial_match if >= 0.3, else mismatch. Keep explanation to one short sentence.
+""".strip()
+_JUDGE_USER_TEMPLATE = "REFERENCE ANSWER:\n{reference}\n\nGENERATED SOLUTION:\n{generated}"
+_VALID_CATS = frozenset({"good_match", "partial_match", "mismatch"})
+# Strict structured output: the API enforces the shape, so the prompt doesn't have to spell it out
+_JUDGE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "judge",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "similarity": {"type": "number"},
+                "category": {"type": "string", "enum": sorted(_VALID_CATS)},
+                "explanation": {"type": "string"},
+            },
+            # strict mode requires every property to be listed here
+            "required": ["similarity", "category", "explanation"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+async def allm_grade_solution(llm, reference: str, generated: str) -> dict:
+    """Ask the LLM how well the generated solution matches the reference answer."""
+    resp = await llm.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": _JUDGE_SYSTEM_PROMPT},
+            {"role": "user", "content": _JUDGE_USER_TEMPLATE.format(reference=reference, generated=generated)},
+        ],
+        temperature=0,
+        response_format=_JUDGE_RESPONSE_FORMAT,
+    )
+    data = orjson.loads(resp.choices[0].message.content)
+    similarity = min(1.0, max(0.0, float(data["similarity"])))
+    category = data.get("category")
+    if category not in _VALID_CATS:
+        category = "mismatch"
+    return {"similarity": similarity, "category": category, "explanation": data.get("explanation", "")}
+
+
+def solution_category(similarity: float) -> str:
+    if similarity >= GOOD_MATCH_THRESHOLD:
+        return "good_match"
+    if similarity >= PARTIAL_MATCH_THRESHOLD:
+        return "partial_match"
+    return "mismatch"
+
+
+def bucket_similarities(sims: np.ndarray) -> tuple[int, int, int]:
+    """(good, partial, bad) counts for an array of similarities, same thresholds as solution_category."""
+    good = int(np.count_nonzero(sims >= GOOD_MATCH_THRESHOLD))
+    partial = int(np.count_nonzero(sims >= PARTIAL_MATCH_THRESHOLD)) - good
+    return good, partial, int(sims.size) - good - partial
+
+
+async def aembedding_similarities(llm, references: list[str], generated: list[str]) -> np.ndarray:
+    """
+    Cosine similarity of each (reference, generated) pair, using batched
+    embeddings.create calls instead of one judge completion per ticket.
+    Pairs whose batch failed are NaN, so one bad batch doesn't abort the sweep.
+    """
+    sims = np.full(len(references), np.nan, dtype=np.float32)
+    # Each request embeds both sides of the same pairs, so a failure maps to exactly those pairs
+    step = max(1, EMBEDDING_BATCH_SIZE // 2)
+    for i in range(0, len(references), step):
+        refs, gens = references[i:i + step], generated[i:i + step]
+        try:
+            resp = await llm.embeddings.create(model=JUDGE_EMBEDDING_MODEL, input=refs + gens)
+        except Exception as e:
+            print(f"❌ Embedding batch {i}-{i + len(refs)} failed: {e}")
+            continue
+        mat = np.asarray([d.embedding for d in resp.data], dtype=np.float32)
+        mat /= np.maximum(np.linalg.norm(mat, axis=1, keepdims=True), 1e-12)
+        sims[i:i + len(refs)] = np.clip((mat[:len(refs)] * mat[len(refs):]).sum(axis=1), 0.0, 1.0)
+    return sims
+
+
+async def run_solution_evaluation_async(
+    limit: int = 500, top_k: int = 5, concurrency: int = 16, judge: str = "embedding"
+) -> dict:
+    """judge="embedding" (default) scores by cosine similarity; judge="llm" uses allm_grade_solution."""
+    # Own client per run: its HTTP/2 pool is bound to this event loop, which asyncio.run() closes
+    llm = new_async_client()
+    try:
+        return await _solution_sweep(llm, limit, top_k, concurrency, judge)
+    finally:
+        await llm.close()
+
+
+async def _solution_sweep(llm, limit: int, top_k: int, concurrency: int, judge: str) -> dict:
+    agent = SolutionAgent(async_llm=llm)
+    tickets = load_solution_eval_tickets(limit)
+    if not tickets:
+        return {"total": 0, "good": 0, "partial": 0, "bad": 0, "failed": 0, "avg_similarity": 0.0}
+
+    await asyncio.to_thread(TicketDataAgent().ensure_indexed_many, [t["ticket_id"] for t in tickets])
+
+    # Near-duplicate tickets are graded against their representative's solution
+    qvecs = await asyncio.to_thread(
+        embed_texts, [f"Subject: {t['subject']}\nBody: {t['body']}" for t in tickets]
+    )
+    rep_of = near_duplicate_representatives(qvecs)
+    reps = sorted(set(rep_of))
+    # Followers' reference answers stay out of the representative's context, as in the assignment sweep
+    cluster_ids: dict[int, list[int]] = {}
+    for t, r in zip(tickets, rep_of):
+        cluster_ids.setdefault(r, []).append(t["ticket_id"])
+    print(f"🔁 {len(tickets) - len(reps)} near-duplicate tickets reuse a representative's solution")
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _generate(i):
+        t = tickets[i]
+        async with sem:
+            generated = await agent.generate_solution_async(
+                t["ticket_id"], t["subject"], t["body"], top_k, exclude_ticket_ids=cluster_ids[i]
+            )
+            return generated["solution"]
+
+    async def _grade(reference, solution):
+        async with sem:
+            return await allm_grade_solution(llm, reference, solution)
+
+    rep_solutions = await asyncio.gather(*(_generate(i) for i in reps), return_exceptions=True)
+    solutions = dict(zip(reps, rep_solutions))
+    for i, sol in solutions.items():
+        if isinstance(sol, Exception):
+            print(f"❌ Ticket {tickets[i]['ticket_id']} failed: {sol}")
+
+    failed = 0
+    ok = []
+    for t, r in zip(tickets, rep_of):
+        sol = solutions[r]
+        if isinstance(sol, Exception) or not sol.strip():
+            failed += 1
+        else:
+            ok.append((t, sol))
+
+    if judge == "llm":
+        grades = await asyncio.gather(*(_grade(t["answer"], sol) for t, sol in ok), return_exceptions=True)
+        similarities, categories = [], []
+        for (t, _), g in zip(ok, grades):
+            if isinstance(g, Exception):
+                print(f"❌ Grading ticket {t['ticket_id']} failed: {g}")
+                failed += 1
+            else:
+                similarities.append(g["similarity"])
+                categories.append(g["category"])
+        good = categories.count("good_match")
+        partial = categories.count("partial_match")
+        bad = categories.count("mismatch")
+        avg_similarity = sum(similarities) / len(similarities) if similarities else 0.0
+    else:
+        sims = (
+            await aembedding_similarities(llm, [t["answer"] for t, _ in ok], [sol for _, sol in ok])
+            if ok else np.zeros(0, dtype=np.float32)
+        )
+        graded = sims[~np.isnan(sims)]
+        failed += int(sims.size - graded.size)
+        good, partial, bad = bucket_similarities(graded)
+        avg_similarity = float(graded.mean()) if graded.size else 0.0
+
+    summary = {
+        "total": len(tickets),
+        "good": good,
+        "partial": partial,
+        "bad": bad,
+        "failed": failed,
+        "avg_similarity": avg_similarity,
+    }
+    print(f"✅ Solution evaluation done: {summary}")
+    return summary
+
+
+def run_solution_evaluation(
+    limit: int = 500, top_k: int = 5, concurrency: int = 16, judge: str = "embedding"
+) -> dict:
+    return asyncio.run(run_solution_evaluation_async(limit, top_k, concurrency, judge))
+
+
+if __name__ == "__main__":
+    run_assignment_evaluation(
+        limit=int(sys.argv[1]) if len(sys.argv) > 1 else 3000,
+        concurrency=int(sys.argv[2]) if len(sys.argv) > 2 else 32,
+        checkpoint_path=sys.argv[3] if len(sys.argv) > 3 else "assignment_eval.checkpoint.json",
+    )
@@ -0,0 +1,121 @@
+"""
+Offline accuracy sweep for the AssignmentAgent using the OpenAI Batch API.
+
+Every ticket that already has an assigned_team_id becomes one JSONL request
+(the exact chat.completions body assign_team would send). The file is uploaded
+once, processed as a single batch job (50% cheaper, no per-call round-trips),
+and the results are matched back to tickets by custom_id.
+
+Usage:
+    python -m app.evaluation_batch [limit]
+"""
+import io, sys, time
+import orjson
+
+from app.db import engine
+from app.assignment_agent import AssignmentAgent, parse_assignment, normalize
+from app.llm_client import client
+from app.retriever import embed_texts
+from app.evaluation import load_eval_tickets
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def build_batch_file(agent: AssignmentAgent, tickets, top_k: int = 5) -> bytes:
+    """One JSONL line per ticket, keyed by ticket_id."""
+    # Embed every ticket up front in one batched call instead of one forward pass each
+    qvecs = embed_texts([f"Subject: {t['subject']}\nBody: {t['body']}" for t in tickets])
+
+    buf = io.BytesIO()
+    for t, qvec in zip(tickets, qvecs):
+        body = agent.build_assignment_request(t["ticket_id"], t["subject"], t["body"], top_k, qvec=qvec)
+        if body is None:
+            raise RuntimeError("No teams found in database.")
+        buf.write(orjson.dumps({
+            "custom_id": str(t["ticket_id"]),
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": body,
+        }))
+        buf.write(b"\n")
+    return buf.getvalue()
+
+
+def submit_batch(payload: bytes) -> str:
+    uploaded = client.files.create(file=("assignment_eval.jsonl", payload), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+    print(f"📤 Submitted batch {batch.id} ({len(payload)} bytes)")
+    return batch.id
+
+
+def wait_for_batch(batch_id: str, poll_seconds: int = 30):
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in TERMINAL_STATES:
+            return batch
+        print(f"⏳ Batch {batch_id}: {batch.status}")
+        time.sleep(poll_seconds)
+
+
+def download_results(batch) -> dict:
+    """Map custom_id -> raw model content (None for failed requests)."""
+    results = {}
+    if not batch.output_file_id:
+        return results
+    content = client.files.content(batch.output_file_id).text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            results[item["custom_id"]] = None
+            continue
+        choices = (response.get("body") or {}).get("choices") or []
+        results[item["custom_id"]] = choices[0]["message"]["content"] if choices else None
+    return results
+
+
+def run_assignment_evaluation_batch(limit: int = 3000, top_k: int = 5, poll_seconds: int = 30) -> dict:
+    agent = AssignmentAgent(engine)
+    tickets = load_eval_tickets(limit)
+    if not tickets:
+        return {"total": 0, "correct": 0, "incorrect": 0, "failed": 0, "accuracy": 0.0}
+
+    batch_id = submit_batch(build_batch_file(agent, tickets, top_k))
+    batch = wait_for_batch(batch_id, poll_seconds)
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch_id} ended with status {batch.status}")
+    outputs = download_results(batch)
+
+    correct = incorrect = failed = 0
+    for t in tickets:
+        raw = outputs.get(str(t["ticket_id"]))
+        if raw is None:
+            failed += 1
+            continue
+        result = agent.resolve_without_retry(parse_assignment(raw))
+        if normalize(result["assigned_team_id"]) == normalize(t["assigned_team_id"]):
+            correct += 1
+        else:
+            incorrect += 1
+
+    total = len(tickets)
+    summary = {
+        "total": total,
+        "correct": correct,
+        "incorrect": incorrect,
+        "failed": failed,
+        "accuracy": correct / total if total else 0.0,
+    }
+    print(f"✅ Batch evaluation done: {summary}")
+    return summary
+
+
+if __name__ == "__main__":
+    run_assignment_evaluation_batch(limit=int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
@@ -0,0 +1,34 @@
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from app.config import get_settings
+
+# One pooled HTTP/2 connection set per process, shared by every agent
+_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+# Fail a hung completion instead of holding a request (and its slot) for the SDK's 10 minutes
+LLM_TIMEOUT = 30.0
+
+client = OpenAI(
+    api_key=get_settings().openai_api_key,
+    timeout=LLM_TIMEOUT,
+    http_client=httpx.Client(
+        timeout=LLM_TIMEOUT,
+        transport=httpx.HTTPTransport(retries=2, http2=True, limits=_LIMITS),
+    ),
+)
+
+def new_async_client() -> AsyncOpenAI:
+    """
+    A fresh AsyncOpenAI with its own HTTP/2 pool. The pool is bound to the event loop
+    that first uses it, so code that runs its own asyncio.run() should use (and close) one of these.
+    """
+    return AsyncOpenAI(
+        api_key=get_settings().openai_api_key,
+        timeout=LLM_TIMEOUT,
+        http_client=httpx.AsyncClient(
+            timeout=LLM_TIMEOUT,
+            transport=httpx.AsyncHTTPTransport(retries=2, http2=True, limits=_LIMITS),
+        ),
+    )
+
+# Shared by the API, which runs on a single event loop
+async_client = new_async_client()
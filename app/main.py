@@ -1,4 +1,9 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from typing import List
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import TypeAdapter
+from sqlalchemy import text as sql_text
+from starlette.concurrency import run_in_threadpool
 from app.schemas import (
     SimilarRequest, SimilarResponse, SimilarItem,
     AssignRequest, AssignResponse, SolutionRequest, SolutionResponse, SolutionSource
@@ -6,14 +11,33 @@ from app.schemas import (
 from app.data_agent import TicketDataAgent
 from app.assignment_agent import AssignmentAgent
 from app.solution_agent import SolutionAgent
-from app.retriever import embed_text, top_k_similar
-from app.db import engine
-
-app = FastAPI(title="Smart Tickets – API", version="1.0.0")
-
-data_agent = TicketDataAgent()
-assign_agent = AssignmentAgent(engine)
-solution_agent = SolutionAgent()
+from app.retriever import top_k_similar
+from app.db import engine, init_db
+from app.config import get_settings
+
+def _check_db():
+    with engine.connect() as conn:
+        conn.execute(sql_text("SELECT 1"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema setup (opt-in), then warm one pooled DB connection, build the agents once
+    # and share them via app.state; blocking steps stay off the event loop
+    if get_settings().auto_create_tables:
+        await run_in_threadpool(init_db)
+    await run_in_threadpool(_check_db)
+    app.state.data_agent = await run_in_threadpool(TicketDataAgent)  # loads the embedding model
+    app.state.assign_agent = AssignmentAgent(engine)
+    app.state.solution_agent = SolutionAgent()
+    yield
+    # The OpenAI clients are process-wide singletons (app.llm_client), so they are not closed here
+    engine.dispose()
+
+app = FastAPI(title="Smart Tickets – API", version="1.0.0", lifespan=lifespan)
+
+# Validate whole result lists in one call instead of one model constructor per row
+_SIMILAR_LIST = TypeAdapter(List[SimilarItem])
+_SOURCE_LIST = TypeAdapter(List[SolutionSource])
 
 @app.get("/health")
 def health():
@@ -21,9 +45,10 @@ def health():
 
 # ---------- SIMILAR (by ticket_id) ----------
 @app.post("/similar", response_model=SimilarResponse)
-def similar(req: SimilarRequest) -> SimilarResponse:
+async def similar(req: SimilarRequest, request: Request) -> SimilarResponse:
+    data_agent = request.app.state.data_agent
     # 1) fetch ticket text
-    t = data_agent.get_ticket_text(req.ticket_id)
+    t = await run_in_threadpool(data_agent.get_ticket_text, req.ticket_id)
     if not t:
         raise HTTPException(status_code=404, detail=f"ticket_id {req.ticket_id} not found")
 
@@ -35,22 +60,26 @@ def similar(req: SimilarRequest) -> SimilarResponse:
 
     # 2) ensure embeddings exist for this ticket (safe no-op if already indexed)
     try:
-        data_agent.ensure_indexed(req.ticket_id)
+        await run_in_threadpool(data_agent.ensure_indexed, req.ticket_id)
     except Exception as e:
         # not fatal; proceed anyway
         print(f"Indexing skipped/failed for ticket {req.ticket_id}: {e}")
 
-    # 3) embed & search
-    qvec = embed_text(text)
-    rows = top_k_similar(qvec, top_k=req.top_k, exclude_ticket_id=req.ticket_id)  # ✅ pass exclude id
-    return SimilarResponse(results=[SimilarItem(**r) for r in rows])
+    # 3) embed (cached per ticket) & search
+    qvec = await run_in_threadpool(data_agent.get_query_vec, req.ticket_id)
+    rows = await run_in_threadpool(
+        top_k_similar, qvec, top_k=req.top_k, exclude_ticket_id=req.ticket_id  # ✅ pass exclude id
+    )
+    return SimilarResponse(results=_SIMILAR_LIST.validate_python(rows))
 
 
 # ---------- ASSIGN (by ticket_id) ----------
 @app.post("/assign", response_model=AssignResponse)
-def assign(req: AssignRequest) -> AssignResponse:
+async def assign(req: AssignRequest, request: Request) -> AssignResponse:
+    data_agent = request.app.state.data_agent
+    assign_agent = request.app.state.assign_agent
     # 1) fetch ticket text
-    t = data_agent.get_ticket_text(req.ticket_id)
+    t = await run_in_threadpool(data_agent.get_ticket_text, req.ticket_id)
     if not t:
         raise HTTPException(status_code=404, detail=f"ticket_id {req.ticket_id} not found")
 
@@ -59,12 +88,13 @@ def assign(req: AssignRequest) -> AssignResponse:
 
     # 2) ensure embeddings exist for this ticket (optional safeguard)
     try:
-        data_agent.ensure_indexed(req.ticket_id)
+        await run_in_threadpool(data_agent.ensure_indexed, req.ticket_id)
     except Exception as e:
         print(f"Indexing skipped/failed for ticket {req.ticket_id}: {e}")
 
     # 3) run assignment (LLM + strict team validation + retry)
-    result = assign_agent.assign_team(req.ticket_id, subject, body, req.top_k)
+    qvec = await run_in_threadpool(data_agent.get_query_vec, req.ticket_id)
+    result = await assign_agent.assign_team_async(req.ticket_id, subject, body, req.top_k, qvec=qvec)
     assigned_team_id = result.get("assigned_team_id") or ""
     assigned_team_name = result.get("assigned_team_name") or ""
     reasoning = result.get("reasoning") or "No reasoning provided."
@@ -80,7 +110,7 @@ def assign(req: AssignRequest) -> AssignResponse:
             message="No valid team_id returned; not persisted."
         )
 
-    persisted = data_agent.update_suggested_team(req.ticket_id, assigned_team_id)
+    persisted = await run_in_threadpool(data_agent.update_suggested_team, req.ticket_id, assigned_team_id)
 
     return AssignResponse(
         ticket_id=req.ticket_id,
@@ -93,9 +123,11 @@ def assign(req: AssignRequest) -> AssignResponse:
 
 
 @app.post("/solution", response_model=SolutionResponse)
-def solution(req: SolutionRequest) -> SolutionResponse:
+async def solution(req: SolutionRequest, request: Request) -> SolutionResponse:
+    data_agent = request.app.state.data_agent
+    solution_agent = request.app.state.solution_agent
     # 1) fetch subject/body
-    t = data_agent.get_ticket_text(req.ticket_id)
+    t = await run_in_threadpool(data_agent.get_ticket_text, req.ticket_id)
     if not t:
         raise HTTPException(status_code=404, detail=f"ticket_id {req.ticket_id} not found")
     subject = t.get("subject") or ""
@@ -103,22 +135,24 @@ def solution(req: SolutionRequest) -> SolutionResponse:
 
     # 2) (optional) ensure indexed
     try:
-        data_agent.ensure_indexed(req.ticket_id)
+        await run_in_threadpool(data_agent.ensure_indexed, req.ticket_id)
     except Exception as e:
         print(f"Indexing skipped/failed for ticket {req.ticket_id}: {e}")
 
     # 3) generate solution with RAG
-    result = solution_agent.generate_solution(
+    qvec = await run_in_threadpool(data_agent.get_query_vec, req.ticket_id)
+    result = await solution_agent.generate_solution_async(
         ticket_id=req.ticket_id,
         subject=subject,
         body=body,
-        top_k=req.top_k
+        top_k=req.top_k,
+        qvec=qvec
     )
     solution_text = result.get("solution", "No solution generated.")
-    sources = [SolutionSource(**s) for s in result.get("sources", [])]
+    sources = _SOURCE_LIST.validate_python(result.get("sources", []))
 
     # 4) persist suggested_answer
-    persisted = data_agent.update_suggested_answer(req.ticket_id, solution_text)
+    persisted = await run_in_threadpool(data_agent.update_suggested_answer, req.ticket_id, solution_text)
 
     return SolutionResponse(
         ticket_id=req.ticket_id,
@@ -1,10 +1,17 @@
 from sqlalchemy.orm import declarative_base, relationship, Mapped, mapped_column
-from sqlalchemy import String, Integer, DateTime, ForeignKey
-from datetime import datetime
-from pgvector.sqlalchemy import Vector
+from sqlalchemy import String, Integer, DateTime, ForeignKey, Index
+from datetime import datetime, timezone
+from sqlalchemy.dialects.postgresql import ARRAY
+from pgvector.sqlalchemy import HALFVEC
 
 Base = declarative_base()
 
+_UTC = timezone.utc
+
+def utcnow() -> datetime:
+    """Naive UTC timestamp for DateTime columns (datetime.utcnow() is deprecated)."""
+    return datetime.now(_UTC).replace(tzinfo=None)
+
 class User(Base):
     __tablename__ = "users"
     user_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -37,15 +44,8 @@ class Ticket(Base):
     assigned_team_user_id: Mapped[int | None] = mapped_column(Integer)
     suggested_assigned_team_id: Mapped[str | None] = mapped_column(String)
     status: Mapped[str | None] = mapped_column(String)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    tag_1: Mapped[str | None] = mapped_column(String)
-    tag_2: Mapped[str | None] = mapped_column(String)
-    tag_3: Mapped[str | None] = mapped_column(String)
-    tag_4: Mapped[str | None] = mapped_column(String)
-    tag_5: Mapped[str | None] = mapped_column(String)
-    tag_6: Mapped[str | None] = mapped_column(String)
-    tag_7: Mapped[str | None] = mapped_column(String)
-    tag_8: Mapped[str | None] = mapped_column(String)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
+    tags: Mapped[list[str] | None] = mapped_column(ARRAY(String))  # up to 8
 
     requester = relationship("User", back_populates="tickets")
 
@@ -54,4 +54,15 @@ class TicketEmbedding(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     ticket_id: Mapped[int] = mapped_column(Integer, ForeignKey("tickets.ticket_id"))
     chunk_text: Mapped[str | None] = mapped_column(String)
-    embedding = mapped_column(Vector(384))
+    embedding = mapped_column(HALFVEC(384))  # fp16: half the bytes per k-NN candidate
+
+    __table_args__ = (
+        # Approximate k-NN for top_k_similar (ORDER BY embedding <#> :qvec; vectors are unit length)
+        Index(
+            "ix_ticket_embeddings_embedding_halfvec_ip",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "halfvec_ip_ops"},
+        ),
+    )
@@ -0,0 +1,40 @@
+import numpy as np
+
+
+class OnnxMiniLMEmbedder:
+    """
+    Drop-in replacement for HuggingFaceEmbeddings (embed_query / embed_documents)
+    backed by an INT8-quantized ONNX export of all-MiniLM-L6-v2 on onnxruntime.
+    Mean-pools token embeddings and L2-normalizes, like the sentence-transformers model.
+
+    Export once with:
+        optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 onnx_minilm/
+        optimum-cli onnxruntime quantize --onnx_model onnx_minilm --avx512_vnni -o onnx_minilm_int8
+    """
+    def __init__(self, model_path: str, batch_size: int = 32, max_length: int = 256):
+        # Optional dependency: only needed when EMBEDDING_ONNX_PATH is set
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_path, provider="CPUExecutionProvider")
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        enc = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np"
+        )
+        hidden = self.model(**enc).last_hidden_state
+        mask = enc["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        out: list[list[float]] = []
+        for i in range(0, len(texts), self.batch_size):
+            out.extend(self._encode(texts[i:i + self.batch_size]).tolist())
+        return out
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._encode([text])[0].tolist()
@@ -1,18 +1,76 @@
+import threading
+from contextlib import contextmanager
+from hashlib import blake2b
+import numpy as np
+from cachetools import LRUCache
 from sqlalchemy import text
 from sqlalchemy.engine import RowMapping
-from .db import engine
-from langchain_huggingface import HuggingFaceEmbeddings
-from sqlalchemy import text
+from .db import engine, autocommit_engine, settings
+from .embedding import get_embedder
+
+
+# MiniLM truncates at 256 tokens anyway; clipping first saves tokenizing text that is thrown away
+TEXT_CLIP = 1500
 
+# Repeat queries for the same ticket text skip the model: 4096 x 384 float32 ≈ 6 MB
+_embed_cache: LRUCache = LRUCache(maxsize=4096)
+_embed_lock = threading.Lock()
 
-# Use the same sentence-transformers model (384-d)
-_embedder = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+def embed_text(text_value: str) -> np.ndarray:
+    """Read-only float32 embedding, memoized by a hash of the text (so edited text never hits a stale entry)."""
+    text_value = (text_value or "")[:TEXT_CLIP]
+    key = blake2b(text_value.encode(), digest_size=16).digest()
+    with _embed_lock:
+        vec = _embed_cache.get(key)
+    if vec is not None:
+        return vec
+    vec = np.asarray(get_embedder().embed_query(text_value), dtype=np.float32)
+    # Read-only, so callers can never corrupt a cache entry
+    vec.setflags(write=False)
+    with _embed_lock:
+        _embed_cache[key] = vec
+    return vec
 
-def embed_text(text_value: str) -> list[float]:
-    return _embedder.embed_query(text_value or "")
+def embed_texts(texts: list[str]) -> list[list[float]]:
+    """Embed many texts in one batched forward pass (for bulk/offline jobs)."""
+    return get_embedder().embed_documents([(t or "")[:TEXT_CLIP] for t in texts])
 
-def top_k_similar(qvec, top_k=5, exclude_ticket_id=None):
-    qvec_str = "[" + ",".join(map(str, qvec)) + "]"
+# An HNSW scan yields at most ef_search candidates and the exclusion filter runs afterwards, so
+# ef_search must exceed top_k by room for the excluded tickets' own chunks
+EF_SEARCH_MARGIN = 40
+# pgvector rejects larger values
+EF_SEARCH_MAX = 1000
+
+@contextmanager
+def _knn_connection(top_k: int):
+    """Connection for a k-NN read whose effective hnsw.ef_search is at least top_k + margin."""
+    ef_search = min(int(top_k) + EF_SEARCH_MARGIN, EF_SEARCH_MAX)
+    if ef_search <= settings.hnsw_ef_search:
+        # Common case: the per-connection default suffices, single autocommit statement
+        with autocommit_engine.connect() as conn:
+            yield conn
+        return
+    # SET LOCAL only lasts inside a transaction, so the pooled connection keeps its default
+    with engine.begin() as conn:
+        conn.execute(text(f"SET LOCAL hnsw.ef_search = {ef_search}"))
+        yield conn
+
+def _exclusions(exclude) -> list[int]:
+    """None, one ticket id, or several -> list of ticket ids to leave out of the neighbours."""
+    if exclude is None:
+        return []
+    if isinstance(exclude, (int, np.integer)):
+        return [int(exclude)]
+    return [int(t) for t in exclude]
+
+def top_k_similar(qvec, top_k=5, exclude_ticket_id=None, extra_exclude_ids=None):
+    """
+    Nearest chunks to qvec. exclude_ticket_id is the query ticket itself; extra_exclude_ids
+    (e.g. its near-duplicates in an evaluation) are left out as well.
+    """
+    # Bound as a pgvector value (register_vector), not a 384-float string to re-parse
+    qvec = np.asarray(qvec, dtype=np.float32)
+    exclude_ids = _exclusions(exclude_ticket_id) + _exclusions(extra_exclude_ids)
 
     query = text("""
         SELECT
@@ -22,20 +80,71 @@ def top_k_similar(qvec, top_k=5, exclude_ticket_id=None):
             t.assigned_team_id,
             tm.team_name AS assigned_team_name,
             te.id AS chunk_id,
-            (te.embedding <-> (:qvec)::vector) AS score
+            1 + (te.embedding <#> (:qvec)::halfvec) AS score   -- cosine distance (unit vectors)
         FROM ticket_embeddings te
         JOIN tickets t   ON te.ticket_id = t.ticket_id
         LEFT JOIN teams tm ON t.assigned_team_id = tm.team_id
-        WHERE (:exclude_id IS NULL OR te.ticket_id <> :exclude_id)   -- ✅ explicit exclusion
-        ORDER BY score ASC
+        WHERE te.ticket_id <> ALL(CAST(:exclude_ids AS integer[]))   -- ✅ explicit exclusion
+        ORDER BY te.embedding <#> (:qvec)::halfvec   -- matches the HNSW halfvec_ip_ops index
         LIMIT :top_k;
     """)
 
-    with engine.begin() as conn:
+    with _knn_connection(top_k) as conn:
         rows = conn.execute(
             query,
-            {"qvec": qvec_str, "top_k": top_k, "exclude_id": exclude_ticket_id}
+            {"qvec": qvec, "top_k": top_k, "exclude_ids": exclude_ids}
         ).mappings().all()
 
     return [dict(r) for r in rows]
 
+
+def top_k_similar_many(qvecs, top_k=5, exclude_ticket_ids=None) -> list[list[dict]]:
+    """
+    top_k_similar for several query vectors in one statement (one LATERAL k-NN per query).
+    exclude_ticket_ids has one entry per query: None, a ticket id, or a list of ticket ids.
+    """
+    if not len(qvecs):
+        return []
+    qvecs = [np.asarray(q, dtype=np.float32) for q in qvecs]
+    if exclude_ticket_ids is None:
+        exclude_ticket_ids = [None] * len(qvecs)
+    # Postgres arrays can't be ragged, so each query's exclusions travel as one "1,2,3" string
+    excludes = [",".join(map(str, _exclusions(e))) for e in exclude_ticket_ids]
+
+    query = text("""
+        SELECT q.ord, n.*
+        FROM (
+            SELECT u.qvec, u.ord, CAST(string_to_array(u.exclude, ',') AS integer[]) AS exclude_ids
+            FROM unnest(CAST(:qvecs AS halfvec[]), CAST(:excludes AS text[]))
+                 WITH ORDINALITY AS u(qvec, exclude, ord)
+        ) q
+        CROSS JOIN LATERAL (
+            SELECT
+                t.ticket_id,
+                t.subject AS title,
+                t.answer,
+                t.assigned_team_id,
+                tm.team_name AS assigned_team_name,
+                te.id AS chunk_id,
+                1 + (te.embedding <#> q.qvec) AS score
+            FROM ticket_embeddings te
+            JOIN tickets t   ON te.ticket_id = t.ticket_id
+            LEFT JOIN teams tm ON t.assigned_team_id = tm.team_id
+            WHERE te.ticket_id <> ALL(q.exclude_ids)
+            ORDER BY te.embedding <#> q.qvec
+            LIMIT :top_k
+        ) n
+        ORDER BY q.ord, n.score;
+    """)
+
+    with _knn_connection(top_k) as conn:
+        rows = conn.execute(
+            query,
+            {"qvecs": qvecs, "excludes": excludes, "top_k": top_k}
+        ).mappings().all()
+
+    results: list[list[dict]] = [[] for _ in qvecs]
+    for r in rows:
+        r = dict(r)
+        results[r.pop("ord") - 1].append(r)
+    return results
@@ -47,4 +47,10 @@ class SolutionResponse(BaseModel):
     solution: str
     sources: List[SolutionSource]
     persisted: bool                     
-    message: Optional[str] = None       
\ No newline at end of file
+    message: Optional[str] = None       
+
+# ----- LLM outputs -----
+class AssignmentOut(BaseModel):
+    assigned_team_id: str
+    assigned_team_name: str
+    reasoning: Optional[str] = None
@@ -0,0 +1,87 @@
+import threading
+import time
+import numpy as np
+
+
+# Shared defaults for the agents' caches: near-duplicate tickets (cosine >= 0.95)
+# reuse a result from the last 5 minutes
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_SIZE = 2048
+SEMANTIC_CACHE_TTL = 300
+
+
+def l2_normalize(vec) -> np.ndarray:
+    v = np.asarray(vec, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(v)
+    return v / norm if norm > 0 else v
+
+
+class SemanticCache:
+    """
+    In-memory cache of LLM results keyed by query embedding.
+    Vectors are L2-normalized, so the inner product is the cosine similarity;
+    a lookup is one exact flat search (matrix-vector product) over the cache.
+    Entries expire after `ttl` seconds (None = never); when full, the least
+    recently used entry is replaced. Putting a near-duplicate of an existing
+    query (cosine >= threshold) overwrites that entry instead of adding one.
+    """
+    def __init__(self, dim: int, threshold: float = 0.95, max_size: int = 2048, ttl: float | None = None):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self._vecs = np.zeros((max_size, dim), dtype=np.float32)
+        self._results: list[dict | None] = [None] * max_size
+        self._last_used = np.zeros(max_size, dtype=np.int64)
+        self._expires = np.full(max_size, np.inf)
+        self._size = 0
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _search(self, q: np.ndarray) -> tuple[int, float]:
+        if self._size == 0:
+            return -1, -1.0
+        scores = self._vecs[:self._size] @ q
+        # Expired entries never match
+        scores[self._expires[:self._size] <= time.monotonic()] = -np.inf
+        i = int(np.argmax(scores))
+        return i, float(scores[i])
+
+    def get(self, qvec) -> dict | None:
+        """Return a copy of the cached result if a stored query has cosine >= threshold."""
+        q = l2_normalize(qvec)
+        with self._lock:
+            i, score = self._search(q)
+            if i < 0 or score < self.threshold:
+                return None
+            self._clock += 1
+            self._last_used[i] = self._clock
+            return dict(self._results[i])
+
+    def put(self, qvec, result: dict, ttl: float | None = None):
+        q = l2_normalize(qvec)
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            i, score = self._search(q)
+            if i < 0 or score < self.threshold:
+                if self._size < self.max_size:
+                    i = self._size
+                    self._size += 1
+                else:
+                    # Prefer an expired slot, otherwise the least recently used one
+                    expired = np.flatnonzero(self._expires <= time.monotonic())
+                    i = int(expired[0]) if expired.size else int(np.argmin(self._last_used))
+            self._clock += 1
+            self._vecs[i] = q
+            self._results[i] = dict(result)
+            self._last_used[i] = self._clock
+            self._expires[i] = time.monotonic() + ttl if ttl is not None else np.inf
+
+    def clear(self):
+        with self._lock:
+            self._size = 0
+            self._results = [None] * self.max_size
+            self._last_used[:] = 0
+            self._expires[:] = np.inf
@@ -1,18 +1,21 @@
-import os, re, json
+import re, json, asyncio
+from functools import lru_cache
 from typing import List, Dict
-from openai import OpenAI
 from app.retriever import top_k_similar, embed_text
-
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""))
+from app.llm_client import client, async_client
+from app.config import get_settings
+from app.semantic_cache import SemanticCache, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL
 
 import re
 
 CONTACT_RE = re.compile(r"(contact|call|email|reach\s*out|open a ticket|service desk)", re.I)
 
+# Neighbors come from a small pool of resolved tickets, so the same answers repeat a lot
+@lru_cache(maxsize=8192)
 def _is_actionable(answer: str | None) -> bool:
-    if not answer:
-        return False
     # at least some substance and not just “contact support”
+    if not answer or len(answer) < 40:
+        return False
     if len(answer.strip()) < 40:
         return False
     if CONTACT_RE.search(answer):
@@ -39,6 +42,8 @@ def _safe_parse_json(s: str) -> dict:
                 pass
     return {"solution": s}
 
+NO_SOLUTION = "No solution generated."
+
 class SolutionAgent:
     """
     Generates a solution for a ticket using RAG:
@@ -46,21 +51,81 @@ class SolutionAgent:
     - retrieves similar tickets (excluding the same ticket id)
     - prompts the LLM to synthesize a solution
     """
-    def __init__(self):
-        pass
+    def __init__(self, async_llm=None):
+        # Callers running their own event loop pass a client bound to it
+        self.async_llm = async_llm or async_client
+        # Near-duplicate tickets reuse a recent solution text; sources are always looked up per ticket
+        self._sem_cache = SemanticCache(
+            get_settings().embedding_dim,
+            threshold=SEMANTIC_CACHE_THRESHOLD, max_size=SEMANTIC_CACHE_SIZE, ttl=SEMANTIC_CACHE_TTL,
+        )
 
-    def generate_solution(self, ticket_id: int, subject: str, body: str, top_k: int = 5) -> dict:
+    def generate_solution(self, ticket_id: int, subject: str, body: str, top_k: int = 5, qvec=None) -> dict:
         query_text = f"Subject: {subject or ''}\nBody: {body or ''}".strip()
         if not query_text:
-            return {
-                "solution": "No subject/body found for this ticket. Please provide details.",
-                "sources": []
-            }
+            return self._empty_ticket_result()
 
         # Retrieve neighbors (exclude the same ticket_id)
-        qvec = embed_text(query_text)
+        if qvec is None:
+            qvec = embed_text(query_text)
+        # Sources come from this ticket's own neighbours (never itself), even on a cache hit
         sims = top_k_similar(qvec, top_k=top_k, exclude_ticket_id=ticket_id)
+        prompt, sources = self._build_prompt(query_text, sims)
+        cached = self._cached_solution(qvec, top_k)
+        if cached:
+            return {"solution": cached, "sources": sources}
+
+        resp = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+            response_format={"type": "json_object"}  # remove if your account doesn't support it
+        )
+        return self._remember(qvec, top_k, self._finalize(resp.choices[0].message.content, sources))
+
+    async def generate_solution_async(
+        self, ticket_id: int, subject: str, body: str, top_k: int = 5, qvec=None, exclude_ticket_ids=None
+    ) -> dict:
+        """
+        Same as generate_solution, but awaits the LLM instead of blocking a thread.
+        exclude_ticket_ids: other tickets to keep out of the context (e.g. near-duplicates being graded).
+        """
+        query_text = f"Subject: {subject or ''}\nBody: {body or ''}".strip()
+        if not query_text:
+            return self._empty_ticket_result()
 
+        if qvec is None:
+            qvec = await asyncio.to_thread(embed_text, query_text)
+        sims = await asyncio.to_thread(top_k_similar, qvec, top_k, ticket_id, exclude_ticket_ids)
+        prompt, sources = self._build_prompt(query_text, sims)
+        cached = self._cached_solution(qvec, top_k)
+        if cached:
+            return {"solution": cached, "sources": sources}
+
+        resp = await self.async_llm.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+            response_format={"type": "json_object"}
+        )
+        return self._remember(qvec, top_k, self._finalize(resp.choices[0].message.content, sources))
+
+    def _cached_solution(self, qvec, top_k: int) -> str | None:
+        """Solution text of a near-duplicate ticket, if it was generated with the same top_k."""
+        hit = self._sem_cache.get(qvec)
+        if hit and hit["top_k"] == top_k:
+            return hit["solution"]
+        return None
+
+    def _remember(self, qvec, top_k: int, result: dict) -> dict:
+        # Only the text is shared: sources belong to the ticket they were retrieved for.
+        # Don't cache the placeholder returned when the model gave nothing usable
+        if result["solution"] != NO_SOLUTION:
+            self._sem_cache.put(qvec, {"solution": result["solution"], "top_k": top_k})
+        return result
+
+    @staticmethod
+    def _build_prompt(query_text: str, sims: List[Dict]) -> tuple[str, List[Dict]]:
         # Build concise context from neighbors (keep only actionable answers)
         lines, sources = [], []
         for r in sims:
@@ -104,19 +169,22 @@ class SolutionAgent:
             Respond **only** as a minified JSON object with this exact schema:
             {{"solution":"<markdown with numbered steps and short notes>"}}
             """
+        return prompt, sources
 
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-            response_format={"type": "json_object"}  # remove if your account doesn't support it
-        )
-        raw = resp.choices[0].message.content
+    @staticmethod
+    def _finalize(raw: str, sources: List[Dict]) -> dict:
         parsed = _safe_parse_json(raw)
 
         # Guarantee schema
-        solution = parsed.get("solution") or "No solution generated."
+        solution = parsed.get("solution") or NO_SOLUTION
         return {
             "solution": solution,
             "sources": sources
         }
+
+    @staticmethod
+    def _empty_ticket_result() -> dict:
+        return {
+            "solution": "No subject/body found for this ticket. Please provide details.",
+            "sources": []
+        }
@@ -0,0 +1,19 @@
+-- Collapse tickets.tag_1..tag_8 into a single text[] column (order kept, NULLs dropped).
+BEGIN;
+
+ALTER TABLE tickets ADD COLUMN IF NOT EXISTS tags text[];
+
+UPDATE tickets
+SET tags = array_remove(ARRAY[tag_1, tag_2, tag_3, tag_4, tag_5, tag_6, tag_7, tag_8], NULL);
+
+ALTER TABLE tickets
+    DROP COLUMN tag_1,
+    DROP COLUMN tag_2,
+    DROP COLUMN tag_3,
+    DROP COLUMN tag_4,
+    DROP COLUMN tag_5,
+    DROP COLUMN tag_6,
+    DROP COLUMN tag_7,
+    DROP COLUMN tag_8;
+
+COMMIT;
@@ -0,0 +1,17 @@
+-- Switch k-NN from L2 (<->) to inner product (<#>) on unit-length embeddings.
+-- Requires pgvector >= 0.7 for l2_normalize().
+BEGIN;
+
+-- Rows written before normalize_embeddings=True; no-op for vectors that are already unit length
+UPDATE ticket_embeddings
+SET embedding = l2_normalize(embedding)
+WHERE embedding IS NOT NULL;
+
+DROP INDEX IF EXISTS ix_ticket_embeddings_embedding_hnsw;
+
+COMMIT;
+
+-- Outside the transaction so the build doesn't block writes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ticket_embeddings_embedding_hnsw_ip
+    ON ticket_embeddings USING hnsw (embedding vector_ip_ops)
+    WITH (m = 16, ef_construction = 64);
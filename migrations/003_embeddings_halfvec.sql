@@ -0,0 +1,14 @@
+-- Store embeddings as fp16 halfvec(384): 768 bytes per row instead of 1536.
+-- Requires pgvector >= 0.7.
+BEGIN;
+
+DROP INDEX IF EXISTS ix_ticket_embeddings_embedding_hnsw_ip;
+
+ALTER TABLE ticket_embeddings
+    ALTER COLUMN embedding TYPE halfvec(384) USING embedding::halfvec(384);
+
+COMMIT;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ticket_embeddings_embedding_halfvec_ip
+    ON ticket_embeddings USING hnsw (embedding halfvec_ip_ops)
+    WITH (m = 16, ef_construction = 64);